@@ -1,4 +1,5 @@
 import atexit
+import bisect
 import os
 import zipfile
 from shutil import rmtree, copy, copytree
@@ -6,10 +7,12 @@ import tkinter as tk
 from tkinter import filedialog
 from subprocess import Popen
 from os import path
-from wadmod import ModEntry, Wad, ModOverlay, VerifyGameDir
+from wadmod import Wad, ModOverlay, OverlayCache, VerifyGameDir, is_mod, create_mod_list
 
 
 VERSION = 1.0
+CACHE_BUDGET = 4 * 1024 * 1024 * 1024
+OVERLAY_STATE = 'overlay.pickle'
 
 clean_string = lambda p: p.replace('\\', '/')
 
@@ -27,6 +30,7 @@ MSG_GOOD_STOPPED_LCS = 41
 MSG_GOOD_STARTED_LCS = 42
 MSG_GOOD_ADD = 43
 MSG_GOOD_DELETE = 44
+MSG_GOOD_VERIFY = 45
 MSG_GOOD_DEFAULT = 99
 
 class LabelEntry(tk.Frame):
@@ -112,6 +116,7 @@ class MessagePanel(tk.Frame):
             MSG_GOOD_APPLY: ['Successfully applied mods.', 'green', True, False],
             MSG_GOOD_DELETE: ['Successfully deleted mod', 'green', True, False],
             MSG_GOOD_ADD: ['Successfully added mod.', 'green', True, False],
+            MSG_GOOD_VERIFY: ['Overlay verified, no problems found.', 'green', True, False],
             MSG_GOOD_STOPPED_LCS: ['Successfully stopped lolcustomskin', 'green', True, False],
             MSG_GOOD_STARTED_LCS: ['Successfully launched lolcustomskin', 'green', True, False],
             MSG_GOOD_DEFAULT: ['Everything OK!', 'green', True, True],
@@ -160,26 +165,89 @@ class ModListbox(tk.Frame):
         self.label = tk.Label(self, text=text, anchor=tk.CENTER)
         self.label.pack()
 
+        self.search = tk.Entry(self, width=30)
+        self.search.bind('<KeyRelease>', lambda event: self.SetFilter(self.search.get()))
+        self.search.pack(fill=tk.X, padx=(0, 3))
+
         self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL)
 
-        self.list_box = tk.Listbox(self, selectmode = 'extended', yscrollcommand=self.scrollbar.set, width=30, height=13)
+        self.list_box = tk.Listbox(self, selectmode = 'extended', yscrollcommand=self.scrollbar.set, width=30, height=12)
         self.scrollbar.config(command=self.list_box.yview)
         self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y, padx=(0, 3))
         self.list_box.pack(side=tk.LEFT, fill=tk.BOTH, expand=1)
 
+        # All mod names in this box, and the sorted names of the rows shown, so a row is found by bisection
+        self.mods = set()
+        self.rows = []
+        self.colors = {}
+        self.filter = ''
+
         self.UpdateMods(mods)
 
+    def Matches(self, name):
+        return self.filter in name.lower()
+
     def UpdateMods(self, mods):
-        self.list_box.delete(0, 'end')
+        for name in self.mods - mods.keys():
+            self.Remove(name)
         for name in mods.keys():
-            self.list_box.insert(0, name)
+            if name not in self.mods:
+                self.Insert(name)
 
     def GetIndex(self, val):
-        return self.list_box.get(0, 'end').index(val)
+        idx = bisect.bisect_left(self.rows, val)
+        if idx < len(self.rows) and self.rows[idx] == val:
+            return idx
+        return None
+
+    def GetSelected(self):
+        return [self.rows[idx] for idx in self.list_box.curselection()]
+
+    def Insert(self, name):
+        self.mods.add(name)
+        if self.Matches(name):
+            self.ShowRow(name)
+
+    def Remove(self, name):
+        self.mods.discard(name)
+        self.colors.pop(name, None)
+        self.HideRow(name)
+
+    def ShowRow(self, name):
+        idx = bisect.bisect_left(self.rows, name)
+        if idx < len(self.rows) and self.rows[idx] == name:
+            return
+        self.rows.insert(idx, name)
+        self.list_box.insert(idx, name)
+        if name in self.colors:
+            self.list_box.itemconfig(idx, {'bg': self.colors[name]})
+
+    def HideRow(self, name):
+        idx = self.GetIndex(name)
+        if idx is not None:
+            del self.rows[idx]
+            self.list_box.delete(idx)
+
+    def SetFilter(self, text):
+        text = text.lower()
+        if text == self.filter:
+            return
+        self.filter = text
+        for idx in range(len(self.rows) - 1, -1, -1):
+            if not self.Matches(self.rows[idx]):
+                del self.rows[idx]
+                self.list_box.delete(idx)
+        for name in self.mods:
+            if self.Matches(name):
+                self.ShowRow(name)
 
     def SetColor(self, name, color):
-        idx = self.list_box.get(0, 'end').index(name)
-        self.list_box.itemconfig(idx, {'bg': color})
+        if self.colors.get(name, 'white') == color:
+            return
+        self.colors[name] = color
+        idx = self.GetIndex(name)
+        if idx is not None:
+            self.list_box.itemconfig(idx, {'bg': color})
 
 class ModButtons(tk.Frame):
     def __init__(self, master):
@@ -193,11 +261,9 @@ class ModButtons(tk.Frame):
     def MoveMods(self, order: int):
         boxes = [self.master.enabled_box, self.master.disabled_box][::order]
         mods = [self.master.enabled_mods, self.master.disabled_mods][::order]
-        selected = boxes[0].list_box.curselection()
-        for idx in selected[::-1]:
-            name = boxes[0].list_box.get(idx)
-            boxes[1].list_box.insert(0, name)
-            boxes[0].list_box.delete(idx)
+        for name in boxes[0].GetSelected():
+            boxes[0].Remove(name)
+            boxes[1].Insert(name)
             mods[1][name] = mods[0][name]
             del mods[0][name]
         self.master.master.CheckMods()
@@ -248,6 +314,8 @@ class ButtonPanel(tk.Frame):
         self.extract_mods.pack(pady=1)
         self.delete_mod = tk.Button(self, text='Delete Mod(s)', command=self.RemoveMods, width=15)
         self.delete_mod.pack(pady=1)
+        self.verify_overlay = tk.Button(self, text='Verify Overlay', command=self.VerifyOverlay, width=15)
+        self.verify_overlay.pack(pady=1)
         self.start_lolcustomskin = tk.Button(self, text='Launch lolcustomskin', command=self.ToggleLCS,
                                              width=15, wraplength=80, height=3)
         self.start_lolcustomskin.pack(pady=10)
@@ -283,6 +351,8 @@ class ButtonPanel(tk.Frame):
     
     def RecheckMods(self):
         self.master.GetMods()
+        if self.master.overlay is not None:
+            self.master.overlay.rebuild_mod_index()
         self.master.mod_panel.RefreshMods()
         self.master.CheckMods()
 
@@ -321,21 +391,42 @@ class ButtonPanel(tk.Frame):
         #TODO: Check if mod is valid
         gamedir = VerifyGameDir(self.master.gamedir)
         if gamedir and self.master.overlaydir:
-            ModOverlay(self.master.gamedir, self.master.modsdir, self.master.overlaydir, self.master.mod_panel.disabled_mods).force_write()
-        self.master.msg_panel.AddMsg(MSG_GOOD_APPLY)
+            cache = self.master.overlay_cache
+            hits, misses = cache.hits, cache.misses
+            overlay = self.master.GetOverlay()
+            overlay.set_disabled(self.master.mod_panel.disabled_mods)
+            overlay.update_enabled_mods()
+            overlay.auto_write()
+            overlay.save(OVERLAY_STATE)
+            self.master.msg_panel.AddMsg(MSG_GOOD_APPLY, custom=f'Successfully applied mods. ({cache.hits - hits} cached, {cache.misses - misses} built)')
+        else:
+            self.master.msg_panel.AddMsg(MSG_GOOD_APPLY)
+
+    def VerifyOverlay(self):
+        gamedir = VerifyGameDir(self.master.gamedir)
+        if gamedir and self.master.overlaydir:
+            # Verify against the last applied mods, not the pending selection
+            overlay = self.master.GetOverlay()
+            if not overlay.overlay_stamps:
+                self.master.msg_panel.AddMsg(MSG_GOOD_VERIFY, custom='Nothing to verify, apply mods first.')
+                return
+            failed = overlay.repair()
+            overlay.save(OVERLAY_STATE)
+            if failed:
+                self.master.msg_panel.AddMsg(MSG_GOOD_VERIFY, custom=f'Repaired {len(failed)} corrupt overlay wad(s).')
+            else:
+                self.master.msg_panel.AddMsg(MSG_GOOD_VERIFY)
 
     def RemoveMods(self):
-        to_remove = []
-        disabled_list = self.master.mod_panel.disabled_box.list_box
-        enabled_list = self.master.mod_panel.enabled_box.list_box
+        disabled_box = self.master.mod_panel.disabled_box
+        enabled_box = self.master.mod_panel.enabled_box
         
-        self.RemoveMod(disabled_list, self.master.mod_panel.disabled_mods)
-        self.RemoveMod(enabled_list, self.master.mod_panel.enabled_mods)
+        self.RemoveMod(disabled_box, self.master.mod_panel.disabled_mods)
+        self.RemoveMod(enabled_box, self.master.mod_panel.enabled_mods)
 
-    def RemoveMod(self, mod_list, mods):
-        to_remove = []
-        for idx in mod_list.curselection():
-            name = mod_list.get(idx)
+    def RemoveMod(self, mod_box, mods):
+        selected = mod_box.GetSelected()
+        for name in selected:
             if path.isdir('mods/' + name):
                 try:
                     rmtree('mods/' + name)
@@ -346,16 +437,15 @@ class ButtonPanel(tk.Frame):
                     #continue
             else:
                 os.remove('mods/' + name)
-            to_remove.append((name, idx))
             del mods[name]
             self.master.msg_panel.AddMsg(MSG_GOOD_DELETE, custom=f'Successfully deleted {name}')
 
-        if len(mod_list.curselection()) > 1:
-            self.master.msg_panel.AddMsg(MSG_GOOD_DELETE, custom=f'Successfully deleted {len(mod_list.curselection())} mods')
+        if len(selected) > 1:
+            self.master.msg_panel.AddMsg(MSG_GOOD_DELETE, custom=f'Successfully deleted {len(selected)} mods')
 
-        for key, idx in to_remove[::-1]:
-            mod_list.delete(idx)
-            del self.master.mods[key]
+        for name in selected:
+            mod_box.Remove(name)
+            del self.master.mods[name]
         self.master.CheckMods()
 
 class ModManager(tk.Tk):
@@ -378,6 +468,8 @@ class ModManager(tk.Tk):
         self.GetDirs()
 
         self.modsdir = 'mods/'
+        self.overlay_cache = OverlayCache('cache', CACHE_BUDGET)
+        self.overlay = None
         self.gamedir = self.entry_panel['gamedir']
         self.overlaydir = self.entry_panel['overlaydir']
         self.GetMods()
@@ -392,8 +484,20 @@ class ModManager(tk.Tk):
         self.QueryProcess()
 
     def GetMods(self):
-        mods = [dir_ for dir_ in os.listdir(self.modsdir) if path.isdir(path.join(self.modsdir, dir_))]
-        self.mods = {modpath:ModEntry.create_list(self.modsdir + modpath) for modpath in mods}
+        mods = [dir_ for dir_ in os.listdir(self.modsdir) if is_mod(path.join(self.modsdir, dir_))]
+        self.mods = {modpath:create_mod_list(self.modsdir + modpath) for modpath in mods}
+
+    def GetOverlay(self):
+        dirs = (self.gamedir, self.modsdir, self.overlaydir)
+        if self.overlay is None and path.isfile(OVERLAY_STATE):
+            try:
+                self.overlay = ModOverlay.load(OVERLAY_STATE)
+                self.overlay.cache = self.overlay_cache
+            except Exception:
+                self.overlay = None
+        if self.overlay is None or (self.overlay.gamedir, self.overlay.modsdir, self.overlay.overlaydir) != dirs:
+            self.overlay = ModOverlay(*dirs, self.mod_panel.disabled_mods, self.overlay_cache)
+        return self.overlay
 
     def MakeDirs(self):
         os.makedirs('overlay/', exist_ok=True)
@@ -442,8 +546,7 @@ class ModManager(tk.Tk):
         self.processed = {}
         for key, values in self.mod_panel.enabled_mods.items():
             for val in values.values():
-                asset_path = '/'.join(clean_string(val[0]).split('/')[2:])
-                self.CheckMod(asset_path, key)
+                self.CheckMod(val.key, key)
         conflicted_mods = {}
         conflicts = False
         for key, val in self.processed.items():
@@ -467,11 +570,11 @@ class ModManager(tk.Tk):
             self.msg_panel.RemoveMsg(MSG_ERROR_CONFLICT)
 
 
-    def CheckMod(self, asset_path, name):
-        if asset_path in self.processed:
-            self.processed[asset_path].append(name)
+    def CheckMod(self, asset_key, name):
+        if asset_key in self.processed:
+            self.processed[asset_key].append(name)
         else:
-            self.processed[asset_path] = [name]
+            self.processed[asset_key] = [name]
 
     def SaveDisabled(self):
         with open('disabled.txt', 'w') as f:
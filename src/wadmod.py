@@ -1,12 +1,14 @@
 #!/bin/env python3
+import bisect
 import shutil
 import hashlib
+import mmap
 import os
 import pickle
 from os import path
-from typing import Dict, IO, Tuple, NamedTuple
+from typing import Dict, IO, List, Tuple, NamedTuple
+from concurrent.futures import ThreadPoolExecutor
 from struct import Struct
-from glob import glob
 from glob import iglob
 from xxhash import xxh64_intdigest
 from pathlib import Path
@@ -18,9 +20,30 @@ s_WadHeader = Struct('<2sBB256sQL')
 s_WadEntry = Struct('<QlllB?xxQ')
 s_LinkHeader = Struct('<20xL52x').unpack
 s_LinkInfo = Struct('<4xi8xi4xi').unpack
+s_WadIdentity = Struct('<256sQQL')
+s_ModIdentity = Struct('<QQQ')
+s_PackHeader = Struct('<4sLQ')
+s_PackEntry = Struct('<QQQQ')
+
+MODPACK_EXT = '.modpack'
 
 modtime = lambda p: int(path.getmtime(p) * 1000)
 
+def file_stamp(p: str):
+    if not path.isfile(p):
+        return None
+    st = os.stat(p)
+    return (int(st.st_mtime * 1000), st.st_size)
+
+def mod_timestamp(modpath: str) -> int:
+    if path.isfile(modpath):
+        return modtime(modpath)
+    timestamp = modtime(modpath)
+    for root, dirs, files in os.walk(modpath):
+        for name in dirs + files:
+            timestamp = max(timestamp, modtime(path.join(root, name)))
+    return timestamp
+
 def s_ZString(f):
     data = (c for c in iter(lambda: bytes.replace(f.read(1), b'\x00', b''), b''))
     return b''.join(data).decode('ascii')
@@ -29,6 +52,27 @@ def s_ZWString(f):
     data = (c for c in iter(lambda: bytes.replace(f.read(2), b'\x00\x00', b''), b''))
     return b''.join(data).decode('utf-16-le')
 
+def link_file(src: str, dst: str):
+    tmp = dst + '.tmp'
+    if path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+    # replace is a no-op when dst already was a link to src, which would leave tmp linked to it
+    if path.exists(tmp):
+        os.remove(tmp)
+
+def copy_range(inf: IO, outf: IO, size: int):
+    while size:
+        data = inf.read(min(size, 1024*1024))
+        if not data:
+            raise EOFError(inf.name)
+        outf.write(data)
+        size -= len(data)
+
 def Link(fname: str) -> str:
     with open(fname, 'rb') as f:
         link_flags, = s_LinkHeader(f.read(76))
@@ -131,6 +175,67 @@ class ModEntry(NamedTuple):
         with open(self.filepath, 'rb') as inf:
             shutil.copyfileobj(inf, outf)
 
+class PackEntry(NamedTuple):
+    filepath: str
+    key: int
+    size: int
+    sha256: int
+    offset: int
+
+    # Packs a loose mod folder into a single file: header, key sorted toc, contiguous blobs
+    @staticmethod
+    def pack(modpath: str, outpath: str):
+        entries = sorted(ModEntry.create_list(modpath).values(), key=lambda entry: entry.key)
+        data_offset = s_PackHeader.size + s_PackEntry.size * len(entries)
+        tmppath = outpath + '.tmp'
+        with open(tmppath, 'wb') as outf:
+            outf.write(s_PackHeader.pack(b'LCSP', 1, len(entries)))
+            for entry in entries:
+                outf.write(s_PackEntry.pack(entry.key, data_offset, entry.size, entry.sha256))
+                data_offset += entry.size
+            for entry in entries:
+                entry.write_data(outf)
+        os.replace(tmppath, outpath)
+
+    @staticmethod
+    def create_list(packpath: str):
+        with open(packpath, 'rb') as f:
+            header = f.read(s_PackHeader.size)
+            assert len(header) == s_PackHeader.size
+            magic, version, count = s_PackHeader.unpack(header)
+            assert magic == b'LCSP' and version == 1
+            size = s_PackEntry.size
+            total = size * count
+            data = f.read(total)
+            assert len(data) == total
+            data_offset = f.tell()
+            file_size = f.seek(0, os.SEEK_END)
+        entries = {}
+        for o in range(0, total, size):
+            key, offset, entry_size, sha256 = s_PackEntry.unpack(data[o:o+size])
+            assert data_offset <= offset and offset + entry_size <= file_size
+            entries[key] = PackEntry(packpath, key, entry_size, sha256, offset)
+        return entries
+
+    def write_toc(self, outf: IO, diff: int, data_offset: int):
+        outf.write(s_WadEntry.pack(\
+            self.key, data_offset, self.size, self.size, 0, False, self.sha256\
+        ))
+        return data_offset + self.size
+
+    def write_data(self, outf: IO):
+        with open(self.filepath, 'rb') as inf:
+            inf.seek(self.offset)
+            copy_range(inf, outf, self.size)
+
+def is_mod(modpath: str):
+    return path.isdir(modpath) or (path.isfile(modpath) and modpath.endswith(MODPACK_EXT))
+
+def create_mod_list(modpath: str):
+    if path.isfile(modpath):
+        return PackEntry.create_list(modpath)
+    return ModEntry.create_list(modpath)
+
 class Wad(NamedTuple):
     wadpath: str
     signature: bytes
@@ -172,7 +277,11 @@ class Wad(NamedTuple):
         
         diff = s_WadEntry.size * (newcount - oldcount)
         data_offset = self.offset + self.data_size + diff
-        with open(outpath, 'wb') as outf:
+        # Write next to the target and swap it in, outpath may be hard-linked into an OverlayCache
+        tmppath = outpath + '.tmp'
+        if path.exists(tmppath):
+            os.remove(tmppath)
+        with open(tmppath, 'xb') as outf:
             outf.write(s_WadHeader.pack(b'RW', 3, 0, self.signature, self.checksum, newcount))
             for entry in entries:
                 data_offset = entry.write_toc(outf, diff, data_offset)
@@ -181,14 +290,133 @@ class Wad(NamedTuple):
                 shutil.copyfileobj(inf, outf)
             for entry in entries:
                 entry.write_data(outf)
+        os.replace(tmppath, outpath)
+
+    # Appends changed mod blobs to an existing overlay and rewrites only their toc rows and the header.
+    # Returns False when the overlay has to be rewritten instead: toc shape changed or too much dead data.
+    def patch(self, outpath: str, modified: Dict[int, ModEntry], max_dead_size: int) -> bool:
+        if not path.isfile(outpath):
+            return False
+
+        entries = {}
+        entries.update(self.entries)
+        oldcount = len(entries)
+        entries.update(modified)
+        newcount = len(entries)
+        diff = s_WadEntry.size * (newcount - oldcount)
+        base_end = self.offset + self.data_size + diff
+
+        with open(outpath, 'r+b') as f:
+            header = s_WadHeader.unpack(f.read(s_WadHeader.size))
+            magic, major, minor, signature, checksum, count = header
+            if (magic, major, minor, signature, checksum, count) != (b'RW', 3, 0, self.signature, self.checksum, newcount):
+                return False
+            size = s_WadEntry.size
+            data = f.read(size * count)
+            rows = [WadEntry.create(data[o:o+size]) for o in range(0, size * count, size)]
+            if [row.key for row in rows] != sorted(entries.keys()):
+                return False
+            file_size = f.seek(0, os.SEEK_END)
+            if file_size < base_end:
+                return False
+
+            data_offset = file_size
+            patches = []
+            for index, row in enumerate(rows):
+                entry = entries[row.key]
+                if isinstance(entry, WadEntry):
+                    new_row = entry._replace(offset=entry.offset + diff)
+                    if row != new_row:
+                        patches.append((index, new_row, None))
+                        rows[index] = new_row
+                elif row[2:] != (entry.size, entry.size, 0, False, entry.sha256):
+                    new_row = WadEntry(entry.key, data_offset, entry.size, entry.size, 0, False, entry.sha256)
+                    patches.append((index, new_row, entry))
+                    data_offset += entry.size
+                    rows[index] = new_row
+            if not patches:
+                return True
+
+            live = { (row.offset, row.compressed_size) for row in rows if row.offset >= base_end }
+            dead_size = data_offset - base_end - sum(entry_size for _, entry_size in live)
+            if dead_size > max_dead_size:
+                return False
+
+            for _, _, entry in patches:
+                if entry is not None:
+                    entry.write_data(f)
+            for index, new_row, _ in patches:
+                f.seek(s_WadHeader.size + size * index)
+                f.write(s_WadEntry.pack(*new_row))
+            f.seek(0)
+            f.write(s_WadHeader.pack(b'RW', 3, 0, self.signature, self.checksum, newcount))
+        return True
+
+class OverlayCache:
+    def __init__(self, cachedir: str, budget: int):
+        self.cachedir = cachedir
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cachedir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(mods: Dict[int, ModEntry]) -> bytes:
+        h = hashlib.sha256()
+        for key in sorted(mods.keys()):
+            mod_entry = mods[key]
+            h.update(s_ModIdentity.pack(key, mod_entry.size, mod_entry.sha256))
+        return h.digest()
+
+    @staticmethod
+    def key(relpath: str, wad: Wad, mods: Dict[int, ModEntry]) -> str:
+        h = hashlib.sha256(relpath.lower().encode('utf-8'))
+        h.update(s_WadIdentity.pack(wad.signature, wad.checksum, wad.data_size, len(wad.entries)))
+        h.update(OverlayCache.fingerprint(mods))
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        return f'{self.cachedir}/{key}.wad.client'
+
+    def fetch(self, key: str, outpath: str) -> bool:
+        cachepath = self.path(key)
+        if not path.isfile(cachepath):
+            self.misses += 1
+            return False
+        # mtime doubles as the LRU timestamp
+        os.utime(cachepath)
+        os.makedirs(path.dirname(outpath), exist_ok=True)
+        if not (path.isfile(outpath) and path.samefile(cachepath, outpath)):
+            link_file(cachepath, outpath)
+        self.hits += 1
+        return True
+
+    def store(self, key: str, outpath: str):
+        link_file(outpath, self.path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for cachepath in iglob(f'{self.cachedir}/*.wad.client'):
+            st = os.stat(cachepath)
+            entries.append((st.st_mtime, st.st_size, cachepath))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, cachepath in entries:
+            if total <= self.budget:
+                break
+            os.remove(cachepath)
+            total -= size
 
 class ModOverlay:    
-    def __init__(self, gamedir: str, modsdir: str, overlaydir: str, disabled_mods: Dict[str, Tuple[int, str]]):
+    def __init__(self, gamedir: str, modsdir: str, overlaydir: str, disabled_mods: Dict[str, Tuple[int, str]], cache: OverlayCache = None):
         self.gamedir = gamedir
         self.modsdir = modsdir
         self.overlaydir = overlaydir
-        self.disabled_mods = disabled_mods
-        self.gamedir_timestamp = 0
+        self.disabled_mods = dict(disabled_mods)
+        # wad path -> (mtime, size) of every game wad and of every overlay wad as last written
+        self.game_stamps = {}
+        self.overlay_stamps = {}
         self.modsdir_timestamp = 0
         self.modified_dirty = False
         self.overlaydir_timestamp = 0
@@ -196,6 +424,22 @@ class ModOverlay:
         self.key_lookup = {}
         self.mods = {}
         self.modified = {}
+        self.cache = cache
+        # modpath -> (timestamp of its newest file, timestamp of the mod itself, entries) for every mod scanned so far
+        self.scanned = {}
+        # key -> enabled modpaths containing it, in mod order; the first one wins
+        self.claims = {}
+        # key -> modpath currently assigned to it
+        self.owners = {}
+        # modpath -> {wadpath: number of its known keys it won in that wad}
+        self.found = {}
+        # modpath -> wadpath receiving its keys not present in any game wad
+        self.targets = {}
+        # unknown key -> wadpath it was assigned to
+        self.extra = {}
+        self.dirty_wads = set()
+        # dead data an overlay may accumulate from patching before it gets compacted by a full rewrite
+        self.max_dead_size = 64 * 1024 * 1024
 
     @staticmethod
     def load(fpath: str):
@@ -206,95 +450,337 @@ class ModOverlay:
         with open(fpath, 'wb') as f:
             pickle.dump(self, f, protocol=4, fix_imports=False)
         
+    def scan_game_stamps(self):
+        return { wadpath: file_stamp(wadpath) for wadpath in iglob(f"{self.gamedir}/DATA/FINAL/**/*.wad.client", recursive=True) }
+
     def need_rebuild_game_index(self):
-        return self.gamedir_timestamp != modtime(f'{self.gamedir}/DATA/FINAL')
+        return self.game_stamps != self.scan_game_stamps()
 
     def rebuild_game_index(self):
         self.wads.clear()
         self.key_lookup.clear()
-        for wadpath in iglob(f"{self.gamedir}/DATA/FINAL/**/*.wad.client", recursive=True):
+        self.game_stamps = self.scan_game_stamps()
+        for wadpath in self.game_stamps.keys():
             wad = Wad.create(wadpath)
             relpath = path.relpath(wadpath, self.gamedir).replace('\\', '/')
             self.wads[relpath] = wad
             for key in wad.entries.keys():
                 self.key_lookup.setdefault(key, []).append(relpath)
 
-        self.gamedir_timestamp = modtime(f'{self.gamedir}/DATA/FINAL')
         self.modified_dirty = True
         self.overlaydir_timestamp = 0
     
     def need_rebuild_mod_index(self):
         return self.modsdir_timestamp != modtime(self.modsdir)
     
+    # Picks up added, removed and replaced mods, only mods whose own entry in the mods dir changed get walked
     def rebuild_mod_index(self):
-        self.mods.clear()
-        for modpath in glob(f"{self.modsdir}/*"):
-            if path.isdir(modpath) and path.basename(modpath) not in self.disabled_mods:
-                self.mods[modpath] = ModEntry.create_list(modpath)
+        current = []
+        for name in sorted(os.listdir(self.modsdir)):
+            modpath = path.join(self.modsdir, name)
+            if is_mod(modpath):
+                current.append(modpath)
+        for modpath in sorted(self.scanned.keys() - set(current)):
+            self.update_mod(modpath)
+        for modpath in current:
+            if path.basename(modpath) in self.disabled_mods:
+                if modpath in self.mods:
+                    self.remove_mod(modpath)
+                continue
+            scanned = self.scanned.get(modpath)
+            if scanned is None or scanned[1] != modtime(modpath) or modpath not in self.mods:
+                self.update_mod(modpath)
         self.modsdir_timestamp = modtime(self.modsdir)
-        self.modified_dirty = True
-        self.overlaydir_timestamp = 0
-    
+
+    # Rescans a mod if any of its files changed since it was last scanned, costs one stat per file of that mod
+    def update_mod(self, modpath: str):
+        if not is_mod(modpath):
+            if modpath in self.mods:
+                self.remove_mod(modpath)
+            self.scanned.pop(modpath, None)
+            return
+        timestamp = mod_timestamp(modpath)
+        scanned = self.scanned.get(modpath)
+        if scanned is None or scanned[0] != timestamp:
+            if modpath in self.mods:
+                self.remove_mod(modpath)
+            self.scanned[modpath] = (timestamp, modtime(modpath), create_mod_list(modpath))
+        if path.basename(modpath) in self.disabled_mods:
+            if modpath in self.mods:
+                self.remove_mod(modpath)
+        elif modpath not in self.mods:
+            self.add_mod(modpath, self.scanned[modpath][2])
+
+    # Edits inside a mod do not touch the mods dir, so the enabled mods are checked before they get written
+    def update_enabled_mods(self):
+        for modpath in list(self.mods.keys()):
+            self.update_mod(modpath)
+
+    # Adds or removes only the toggled mods
+    def set_disabled(self, disabled_mods: Dict[str, Tuple[int, str]]):
+        toggled = self.disabled_mods.keys() ^ disabled_mods.keys()
+        self.disabled_mods = dict(disabled_mods)
+        for name in sorted(toggled):
+            modpath = path.join(self.modsdir, name)
+            if name in self.disabled_mods:
+                if modpath in self.mods:
+                    self.remove_mod(modpath)
+            elif is_mod(modpath) or modpath in self.scanned:
+                self.update_mod(modpath)
+
+    def add_mod(self, modpath: str, entries: Dict[int, ModEntry]):
+        self.mods[modpath] = entries
+        for key in entries.keys():
+            bisect.insort(self.claims.setdefault(key, []), modpath)
+        if not self.modified_dirty:
+            self.found[modpath] = {}
+            self.targets[modpath] = None
+            self.reassign(entries.keys())
+
+    def remove_mod(self, modpath: str):
+        entries = self.mods.pop(modpath)
+        for key in entries.keys():
+            claims = self.claims[key]
+            claims.remove(modpath)
+            if not claims:
+                del self.claims[key]
+        if not self.modified_dirty:
+            self.reassign(entries.keys())
+            del self.found[modpath]
+            del self.targets[modpath]
+
     def need_rebuild_modified_index(self):
         return self.modified_dirty
     
     def rebuild_modified_index(self):
         self.modified.clear()
-        processed = set()
-        for mod in self.mods.values():
-            found = {}
-            missing = True
-            for key, mod_entry in mod.items():
-                if key in processed:
-                    continue
-                if key in self.key_lookup:
-                    for wadpath in self.key_lookup[key]:
-                        found[wadpath] = found.get(wadpath, 0) + 1
-                        processed.add(key)
-                        self.modified.setdefault(wadpath, {})[key] = mod_entry
-                else:
-                    missing = True
-            if missing and found:
-                wadpath, _ = max(found.items(), key=lambda kvp: kvp[1])
-                for key, mod_entry in mod.items():
-                    if key in processed:
-                        continue
-                    if not key in self.key_lookup:
-                        self.modified[wadpath][key] = mod_entry
-                        processed.add(key)
+        self.owners.clear()
+        self.extra.clear()
+        self.found = { modpath: {} for modpath in self.mods.keys() }
+        self.targets = dict.fromkeys(self.mods.keys())
+        self.reassign(self.claims.keys())
+        self.dirty_wads = set(self.modified.keys())
         self.modified_dirty = False
         self.overlaydir_timestamp = 0
+
+    # Recomputes the owner of each key whose claims changed, keeping first-mod-wins ordering.
+    # Keys not present in any game wad follow their owner to the wad holding most of its won keys.
+    def reassign(self, keys):
+        retarget = set()
+        unknown = {}
+        for key in keys:
+            if key not in self.key_lookup:
+                unknown[key] = None
+                continue
+            old = self.owners.get(key)
+            claims = self.claims.get(key)
+            owner = claims[0] if claims else None
+            if old == owner:
+                continue
+            wadpaths = self.key_lookup[key]
+            if old is not None:
+                del self.owners[key]
+                found = self.found[old]
+                for wadpath in wadpaths:
+                    found[wadpath] -= 1
+                    if not found[wadpath]:
+                        del found[wadpath]
+                    self.unassign(wadpath, key)
+                retarget.add(old)
+            if owner is not None:
+                found = self.found[owner]
+                mod_entry = self.mods[owner][key]
+                for wadpath in wadpaths:
+                    found[wadpath] = found.get(wadpath, 0) + 1
+                    self.modified.setdefault(wadpath, {})[key] = mod_entry
+                    self.dirty_wads.add(wadpath)
+                self.owners[key] = owner
+                retarget.add(owner)
+
+        for modpath in retarget:
+            if modpath not in self.mods:
+                continue
+            found = self.found[modpath]
+            target = min(found.items(), key=lambda kvp: (-kvp[1], kvp[0]))[0] if found else None
+            if target != self.targets[modpath]:
+                self.targets[modpath] = target
+                unknown.update((key, None) for key in self.mods[modpath].keys() if key not in self.key_lookup)
+
+        for key in unknown.keys():
+            owner = next((modpath for modpath in self.claims.get(key, ()) if self.targets[modpath] is not None), None)
+            wadpath = self.targets[owner] if owner is not None else None
+            old = self.extra.get(key)
+            if old is not None and old == wadpath and self.modified[old].get(key) is self.mods[owner][key]:
+                continue
+            self.owners.pop(key, None)
+            if old is not None:
+                self.unassign(self.extra.pop(key), key)
+            if owner is not None:
+                self.modified.setdefault(wadpath, {})[key] = self.mods[owner][key]
+                self.dirty_wads.add(wadpath)
+                self.owners[key] = owner
+                self.extra[key] = wadpath
+
+    def unassign(self, wadpath: str, key: int):
+        mods = self.modified[wadpath]
+        del mods[key]
+        if not mods:
+            del self.modified[wadpath]
+        self.dirty_wads.add(wadpath)
     
     def need_rewrite(self):
         return self.overlaydir_timestamp != modtime(self.overlaydir)
+
+    # Overlay wads that were deleted or changed by something else since they were written
+    def changed_overlay_wads(self):
+        return [wadpath for wadpath in self.modified.keys() if self.overlay_stamps.get(wadpath) != file_stamp(f'{self.overlaydir}/{wadpath}')]
+
+    def write_wad(self, wadpath: str, patch: bool = False, fetch: bool = True):
+        p = f'{self.overlaydir}/{wadpath}'
+        mods = self.modified.get(wadpath)
+        if not mods:
+            if path.isfile(p):
+                os.remove(p)
+            self.overlay_stamps.pop(wadpath, None)
+            return
+        wad = self.wads[wadpath]
+        # Patching a file hard-linked into the cache would change the cached overlay of another profile
+        if patch and path.isfile(p) and os.stat(p).st_nlink > 1:
+            patch = False
+        if self.cache is None:
+            if not (patch and wad.patch(p, mods, self.max_dead_size)):
+                wad.write(p, mods)
+        else:
+            key = OverlayCache.key(wadpath, wad, mods)
+            if not (fetch and self.cache.fetch(key, p)):
+                if not (patch and wad.patch(p, mods, self.max_dead_size)):
+                    wad.write(p, mods)
+                self.cache.store(key, p)
+        self.overlay_stamps[wadpath] = file_stamp(p)
     
     def write(self):
         written = set()
-        for wadpath, mods in self.modified.items():
-            p = f'{self.overlaydir}/{wadpath}'
-            self.wads[wadpath].write(p, mods)
-            written.add(Path(p))
+        self.overlay_stamps.clear()
+        for wadpath in self.modified.keys():
+            self.write_wad(wadpath)
+            written.add(Path(f'{self.overlaydir}/{wadpath}'))
 
         for filepath in iglob(f"{self.overlaydir}/**/*", recursive=True):
             if os.path.isfile(filepath) and not Path(filepath) in written:
                 os.remove(filepath)
 
+        self.dirty_wads.clear()
+        self.overlaydir_timestamp = modtime(self.overlaydir)
+
+    # Writes only the wads touched since the last write, patching existing overlays in place where possible
+    def write_dirty(self):
+        for wadpath in sorted(self.dirty_wads):
+            self.write_wad(wadpath, patch=True)
+
+        for folder in { path.dirname(wadpath) for wadpath in self.dirty_wads }:
+            for filepath in iglob(f"{self.overlaydir}/{folder}/*"):
+                relpath = path.relpath(filepath, self.overlaydir).replace('\\', '/')
+                if os.path.isfile(filepath) and relpath not in self.modified:
+                    os.remove(filepath)
+
+        self.dirty_wads.clear()
         self.overlaydir_timestamp = modtime(self.overlaydir)
     
-    # Rebuilds caches as needed and writes as needed
-    def auto_write(self):
+    # Checks an overlay wad against the index using only its header and toc, deep also rehashes its mod blobs
+    def verify_wad(self, wadpath: str, executor: ThreadPoolExecutor = None) -> bool:
+        p = f'{self.overlaydir}/{wadpath}'
+        wad = self.wads[wadpath]
+        mods = self.modified[wadpath]
+        count = len(wad.entries.keys() | mods.keys())
+        diff = s_WadEntry.size * (count - len(wad.entries))
+        try:
+            with open(p, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                file_size = len(m)
+                toc_end = s_WadHeader.size + s_WadEntry.size * count
+                if file_size < toc_end:
+                    return False
+                header = s_WadHeader.unpack_from(m, 0)
+                if header != (b'RW', 3, 0, wad.signature, wad.checksum, count):
+                    return False
+
+                old = -1
+                mod_rows = {}
+                blobs = []
+                for o in range(s_WadHeader.size, toc_end, s_WadEntry.size):
+                    row = WadEntry(*s_WadEntry.unpack_from(m, o))
+                    if row.key <= old or row.offset < toc_end or row.offset + row.compressed_size > file_size:
+                        return False
+                    old = row.key
+                    if row.key in mods:
+                        if row[2:6] != (row.compressed_size, row.compressed_size, 0, False):
+                            return False
+                        mod_rows[row.key] = ModEntry(p, row.key, row.compressed_size, row.sha256)
+                        blobs.append(row)
+                    elif row.key not in wad.entries or row != wad.entries[row.key]._replace(offset=wad.entries[row.key].offset + diff):
+                        return False
+                if OverlayCache.fingerprint(mod_rows) != OverlayCache.fingerprint(mods):
+                    return False
+
+                if executor is not None:
+                    rehash = lambda row: s_UInt64(hashlib.sha256(m[row.offset:row.offset+row.compressed_size]).digest()[:8])[0] == row.sha256
+                    return all(list(executor.map(rehash, blobs)))
+        except (OSError, ValueError):
+            return False
+        return True
+
+    # Returns the overlay wads that fail verify_wad, wads with unwritten changes are left to the next write
+    def verify(self, deep: bool = False) -> List[str]:
+        # Overlays built against an older game cannot be checked against the current one
+        if self.need_rebuild_game_index():
+            return sorted(self.modified.keys())
+        wadpaths = sorted(self.modified.keys() - self.dirty_wads)
+        if not deep:
+            return [wadpath for wadpath in wadpaths if not self.verify_wad(wadpath)]
+        with ThreadPoolExecutor() as executor:
+            return [wadpath for wadpath in wadpaths if not self.verify_wad(wadpath, executor)]
+
+    # Rewrites only the overlay wads that fail verification, from scratch since their cache entry may be broken too
+    def repair(self, deep: bool = False) -> List[str]:
+        # Rewriting single wads would use stale base offsets after a game update, rebuild the whole overlay instead
+        if self.need_rebuild_game_index():
+            failed = sorted(self.modified.keys())
+            self.rebuild_game_index()
+            self.rebuild_modified_index()
+            self.write()
+            return failed
+        failed = self.verify(deep)
+        for wadpath in failed:
+            self.write_wad(wadpath, fetch=False)
+        return failed
+
+    # Rebuilds caches as needed
+    def auto_rebuild(self):
         if self.need_rebuild_game_index():
             self.rebuild_game_index()
         if self.need_rebuild_mod_index():
             self.rebuild_mod_index()
         if self.need_rebuild_modified_index():
             self.rebuild_modified_index()
+
+    # Rebuilds caches as needed and writes as needed
+    def auto_write(self):
+        self.auto_rebuild()
         if self.need_rewrite():
             self.write()
+            return
+        # Never patch a wad that changed behind our back, nor trust a cache entry it may share an inode with
+        for wadpath in self.changed_overlay_wads():
+            self.write_wad(wadpath, fetch=False)
+            self.dirty_wads.discard(wadpath)
+        if self.dirty_wads:
+            self.write_dirty()
     
     # Performs full rebuild of cache and writes
     def force_write(self):
         self.rebuild_game_index()
+        self.scanned.clear()
+        self.mods.clear()
+        self.claims.clear()
         self.rebuild_mod_index()
         self.rebuild_modified_index()
         self.write()
@@ -312,4 +798,43 @@ def VerifyGameDir(gamedir):
     if path.exists(gamedir + '/League of Legends.exe'):
         return path.normpath(gamedir).replace('\\', '/')
     
-    return ""
\ No newline at end of file
+    return ""
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='lolcustomskin mod tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    pack_parser = commands.add_parser('pack', help=f'pack a mod folder into a single {MODPACK_EXT} file')
+    pack_parser.add_argument('modpath')
+    pack_parser.add_argument('outpath', nargs='?')
+    verify_parser = commands.add_parser('verify', help='verify overlay wads and rewrite the ones that fail')
+    verify_parser.add_argument('gamedir')
+    verify_parser.add_argument('modsdir')
+    verify_parser.add_argument('overlaydir')
+    verify_parser.add_argument('--disabled', help='file listing disabled mod names, one per line')
+    verify_parser.add_argument('--deep', action='store_true', help='also rehash mod data')
+    verify_parser.add_argument('--dry-run', action='store_true', help='only report failing wads')
+    verify_parser.add_argument('--cache', default='cache', help='overlay cache dir of the manager, its entries for repaired wads are replaced')
+    verify_parser.add_argument('--cache-budget', type=int, default=4 * 1024 * 1024 * 1024)
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        modpath = path.normpath(args.modpath)
+        PackEntry.pack(modpath, args.outpath or modpath + MODPACK_EXT)
+    elif args.command == 'verify':
+        disabled_mods = {}
+        if args.disabled:
+            with open(args.disabled, 'r') as f:
+                disabled_mods = {k.strip():None for k in f.readlines()}
+        cache = OverlayCache(args.cache, args.cache_budget) if path.isdir(args.cache) else None
+        overlay = ModOverlay(args.gamedir, args.modsdir, args.overlaydir, disabled_mods, cache)
+        overlay.auto_rebuild()
+        # The overlay on disk is expected to match the mods as they are now
+        overlay.dirty_wads.clear()
+        if args.dry_run:
+            failed = overlay.verify(args.deep)
+        else:
+            failed = overlay.repair(args.deep)
+        for wadpath in failed:
+            print(wadpath)
+        print(f'{len(failed)} of {len(overlay.modified)} overlay wads failed verification')